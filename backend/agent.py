@@ -1,12 +1,16 @@
+import functools
 import logging
 import os
+import threading
+import time
 from pathlib import Path
 from dotenv import load_dotenv
 from datetime import datetime
 import pytz
+import orjson
 
 from livekit import agents
-from livekit.agents import JobContext, WorkerOptions, cli, llm
+from livekit.agents import JobContext, JobProcess, WorkerOptions, cli, llm
 import asyncio
 from livekit.agents.voice import Agent, AgentSession
 from livekit.plugins import deepgram, cartesia, openai, bey, silero
@@ -36,30 +40,10 @@ for key in required_keys:
 
 bey_key = os.environ.get("BEY_API_KEY", "").strip()
 
-# Function to generate system instructions with current date/time
-def get_system_instructions():
-    """
-    Generate system instructions with current date and time.
-    This ensures the LLM has accurate temporal context for scheduling.
-    """
-    # Get current time in IST timezone
-    ist = pytz.timezone('Asia/Kolkata')
-    now = datetime.now(ist)
-    
-    # Format date and time
-    current_date = now.strftime("%Y-%m-%d (%B %d, %Y)")
-    current_time = now.strftime("%H:%M IST (India Standard Time, UTC+5:30)")
-    day_of_week = now.strftime("%A")
-    
-    return f"""You are a helpful and professional voice assistant for a medical clinic, specializing in appointment scheduling.
+_IST = pytz.timezone('Asia/Kolkata')
 
-## Current Date and Time
-**Today is**: {day_of_week}, {current_date}
-**Current Time**: {current_time}
-
-> **Important**: Use this date/time information when users mention relative times like "today", "tomorrow", "next week", etc. This ensures accurate appointment scheduling since you don't have access to real-time data.
-
-## Your Capabilities
+# Static portion of the system prompt; only the date/time header changes
+_STATIC_INSTRUCTIONS = """## Your Capabilities
 You can help users with:
 - Scheduling new appointments
 - Rescheduling existing appointments
@@ -165,6 +149,82 @@ You MUST identify the user before proceeding with any appointment-related tasks.
 - Acknowledge the user's needs promptly
 """
 
+@functools.lru_cache(maxsize=1)
+def _header(minute_bucket: int) -> str:
+    """
+    Build the date/time header for the given minute bucket.
+    Cached so sessions started within the same minute share one string.
+    """
+    now = datetime.fromtimestamp(minute_bucket * 60, _IST)
+    
+    # Format date and time
+    current_date = now.strftime("%Y-%m-%d (%B %d, %Y)")
+    current_time = now.strftime("%H:%M IST (India Standard Time, UTC+5:30)")
+    day_of_week = now.strftime("%A")
+    
+    return f"""You are a helpful and professional voice assistant for a medical clinic, specializing in appointment scheduling.
+
+## Current Date and Time
+**Today is**: {day_of_week}, {current_date}
+**Current Time**: {current_time}
+
+> **Important**: Use this date/time information when users mention relative times like "today", "tomorrow", "next week", etc. This ensures accurate appointment scheduling since you don't have access to real-time data.
+
+"""
+
+# Function to generate system instructions with current date/time
+def get_system_instructions():
+    """
+    Generate system instructions with current date and time.
+    This ensures the LLM has accurate temporal context for scheduling.
+    """
+    return _header(int(time.time() // 60)) + _STATIC_INSTRUCTIONS
+
+# Strong references to fire-and-forget tasks so they aren't garbage collected
+_bg_tasks: set[asyncio.Task] = set()
+
+def _log_exc(task: asyncio.Task):
+    if task.cancelled():
+        return
+    exc = task.exception()
+    if exc is not None:
+        logger.error(f"Background task {task.get_name()} failed: {exc}", exc_info=exc)
+
+def _spawn(coro) -> asyncio.Task:
+    """Start a background task that is tracked and whose failure is logged."""
+    task = asyncio.create_task(coro)
+    _bg_tasks.add(task)
+    task.add_done_callback(_bg_tasks.discard)
+    task.add_done_callback(_log_exc)
+    return task
+
+# Chat messages are persisted by a single background writer in batches
+_MSG_BATCH_SIZE = 32
+_msg_queue: asyncio.Queue = asyncio.Queue(maxsize=500)
+_writer_task: asyncio.Task | None = None
+
+async def _message_writer():
+    """
+    Drain the message queue and insert rows in batches.
+    Runs for the lifetime of the worker process.
+    """
+    while True:
+        batch = [await _msg_queue.get()]
+        while len(batch) < _MSG_BATCH_SIZE and not _msg_queue.empty():
+            batch.append(_msg_queue.get_nowait())
+        try:
+            await db.save_messages(batch)
+        except Exception as e:
+            logger.error(f"Failed to save {len(batch)} messages: {e}")
+        finally:
+            for _ in batch:
+                _msg_queue.task_done()
+
+def _ensure_writer():
+    global _writer_task
+    if _writer_task is None or _writer_task.done():
+        _writer_task = _spawn(_message_writer())
+
 class PersistentChatContext(llm.ChatContext):
     def __init__(self):
         super().__init__()
@@ -173,7 +233,10 @@ class PersistentChatContext(llm.ChatContext):
     def add_message(self, *, role: str, content: str, **kwargs):
         msg = super().add_message(role=role, content=content, **kwargs)
         if self.user_id:
-            asyncio.create_task(db.save_message(self.user_id, role, content))
+            try:
+                _msg_queue.put_nowait({"user_id": self.user_id, "role": role, "content": content})
+            except asyncio.QueueFull:
+                logger.warning(f"Message queue full, dropping {role} message")
         return msg
 
     def set_user_id(self, user_id: str):
@@ -183,11 +246,73 @@ class PersistentChatContext(llm.ChatContext):
         for m in messages:
             super().add_message(role=m['role'], content=m['content'])
 
+# Holds the static system prompt message, built once per process. Sessions
+# share the message object instead of re-creating the multi-KB prompt.
+_TEMPLATE_CTX = PersistentChatContext()
+_TEMPLATE_CTX.add_message(role="system", content=_STATIC_INSTRUCTIONS)
+
+def _new_chat_ctx() -> PersistentChatContext:
+    """Create a session chat context seeded with the current system prompt."""
+    chat_ctx = PersistentChatContext()
+    # Only the date/time header is session specific
+    chat_ctx.add_message(role="system", content=_header(int(time.time() // 60)))
+    chat_ctx.items.extend(_TEMPLATE_CTX.items)
+    return chat_ctx
+
+_DEBUG_PIPELINE = os.environ.get("DEBUG_PIPELINE", "").strip().lower() in ("1", "true", "yes", "on")
+
+def _register_pipeline_logging(session: AgentSession):
+    """Attach handlers that log pipeline events for debugging."""
+    def on_agent_state_changed(ev):
+        logger.info("[PIPELINE] Agent state: %s -> %s", ev.old_state, ev.new_state)
+    
+    def on_user_input_transcribed(ev):
+        if ev.is_final:
+            logger.info("[PIPELINE] ✓ User speech detected: %.100s...", ev.transcript)
+    
+    def on_conversation_item_added(ev):
+        logger.info("[PIPELINE] ✓ %s message added: %.100s...", ev.item.role, ev.item.text_content)
+    
+    def on_function_tools_executed(ev):
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        for call in ev.function_calls:
+            logger.info("[PIPELINE] ✓ Tool call: %s", call.name)
+        logger.info("[PIPELINE] ✓ Tool calls completed: %d", len(ev.function_calls))
+    
+    session.on("agent_state_changed")(on_agent_state_changed)
+    session.on("user_input_transcribed")(on_user_input_transcribed)
+    session.on("conversation_item_added")(on_conversation_item_added)
+    session.on("function_tools_executed")(on_function_tools_executed)
+
+_WARMUP_TIMEOUT = 2.0
+
+def _warmup_db():
+    try:
+        db.warmup()
+        logger.info("Supabase connection warmed up")
+    except Exception as e:
+        logger.warning(f"Supabase warm-up failed: {e}")
+
+def prewarm(proc: JobProcess):
+    """Runs once per worker process before it accepts jobs."""
+    # Load the VAD model once and share it across jobs in this process
+    proc.userdata["vad"] = silero.VAD.load()
+    
+    # Warm-up is best effort: bound it well below LiveKit's process init
+    # timeout so a slow or unreachable Supabase can't stop the worker starting
+    warmup_thread = threading.Thread(target=_warmup_db, name="supabase-warmup", daemon=True)
+    warmup_thread.start()
+    warmup_thread.join(timeout=_WARMUP_TIMEOUT)
+    if warmup_thread.is_alive():
+        logger.warning(f"Supabase warm-up still pending after {_WARMUP_TIMEOUT}s, continuing")
+
 async def entrypoint(ctx: JobContext):
     logger.info(f"Job started for room {ctx.room.name}")
     
     # Create session record in database
     session_id = ctx.room.name  # Use room name as session ID
+    _ensure_writer()
     await create_session(session_id)
     logger.info(f"Created session record for {session_id}")
     
@@ -195,110 +320,151 @@ async def entrypoint(ctx: JobContext):
     system_instructions = get_system_instructions()
     
     # Initialize Persistent ChatContext
-    initial_ctx = PersistentChatContext()
-    initial_ctx.add_message(role="system", content=system_instructions)
+    initial_ctx = _new_chat_ctx()
 
     logger.info(f"Connecting to room {ctx.room.name}")
     await ctx.connect(auto_subscribe=agents.AutoSubscribe.AUDIO_ONLY)
-
-    # Wait for the first participant to connect
-    participant = None
-    if ctx.room.remote_participants:
-        participant = list(ctx.room.remote_participants.values())[0]
-        logger.info(f"Using existing participant: {participant.identity}")
-    else:
-        logger.info("Waiting for participant to join...")
-        participant = await ctx.wait_for_participant()
-        logger.info(f"Participant joined: {participant.identity}")
-
-    # Pass session_id to tools
-    tools_instance = AgentTools(room=ctx.room, chat_ctx=initial_ctx, session_id=session_id)
-    tools_list = llm.find_function_tools(tools_instance)
-
-    # Create session first (required for avatar initialization)
-    session = AgentSession()
-    logger.info("Agent session created")
-    
-    # Set up event handlers to track pipeline
-    @session.on("agent_started")
-    def on_agent_started():
-        logger.info("[PIPELINE] Agent started and ready")
-    
-    @session.on("agent_stopped")
-    def on_agent_stopped():
-        logger.info("[PIPELINE] Agent stopped")
     
-    @session.on("user_speech_committed")
-    def on_user_speech(msg):
-        logger.info(f"[PIPELINE] ✓ User speech detected: {msg.text[:100]}...")
+    disconnected = asyncio.Event()
+    ctx.room.on("disconnected", lambda *_: disconnected.set())
     
-    @session.on("agent_speech_committed")
-    def on_agent_speech(msg):
-        logger.info(f"[PIPELINE] ✓ Agent speech generated: {msg.text[:100]}...")
+    cleanup_task = None
     
-    @session.on("agent_speech_interrupted")
-    def on_interrupted():
-        logger.info("[PIPELINE] Agent speech interrupted by user")
-    
-    @session.on("function_calls_collected")
-    def on_function_calls(calls):
-        for call in calls:
-            logger.info(f"[PIPELINE] ✓ Tool call: {call.function_info.name}")
+    async def _cleanup():
+        # Flush pending chat messages before tearing down
+        try:
+            await asyncio.wait_for(_msg_queue.join(), timeout=5.0)
+        except asyncio.TimeoutError:
+            logger.warning(f"Timed out flushing {_msg_queue.qsize()} pending messages")
+        # Clean up session when it ends
+        await delete_session(session_id)
+        logger.info(f"Deleted session record for {session_id}")
     
-    @session.on("function_calls_finished")
-    def on_function_finished(calls):
-        logger.info(f"[PIPELINE] ✓ Tool calls completed: {len(calls)}")
+    async def cleanup():
+        # Both the disconnect path and the shutdown callback await the same
+        # task, so a cancelled entrypoint can't abandon a half-done cleanup
+        nonlocal cleanup_task
+        if cleanup_task is None:
+            cleanup_task = asyncio.create_task(_cleanup())
+        await asyncio.shield(cleanup_task)
     
+    # Also runs if the worker is shut down before the room disconnects
+    ctx.add_shutdown_callback(cleanup)
+
     # Create the Agent configuration with Silero VAD
     logger.info("Configuring agent with Deepgram STT, Gemini LLM, Cartesia TTS, and Silero VAD")
     
-    # Broadcast system initialization status to frontend
-    async def broadcast_status(component: str, status: str):
-        logger.info(f"Broadcasting status: {component} -> {status}")
+    # Broadcast system initialization status to frontend.
+    # Updates arriving within 20ms of each other are coalesced into one publish.
+    # Nothing is published until a participant is there to receive it.
+    pending_status = {}
+    flush_handle = None
+    participant_joined = False
+    
+    async def _publish_status(components: dict):
         try:
             await ctx.room.local_participant.publish_data(
-                payload=f'{{"type": "system_status", "component": "{component}", "status": "{status}"}}',
+                payload=orjson.dumps({"type": "system_status", "components": components}),
                 reliable=True
             )
-            logger.info(f"Broadcasted {component} status")
+            logger.info(f"Broadcasted status for {', '.join(components)}")
         except Exception as e:
-            logger.error(f"Failed to broadcast status for {component}: {e}")
-    
-    # 1. Initialize STT
-    await broadcast_status("stt", "initializing")
-    stt_instance = deepgram.STT()
-    logger.info(f"[PIPELINE] Deepgram STT initialized: {type(stt_instance).__name__}")
-    await broadcast_status("stt", "ready")
-    
-    # 2. Initialize LLM
-    await broadcast_status("llm", "initializing")
-    llm_instance = openai.LLM(model="gemini-2.0-flash-exp")
-    logger.info(f"[PIPELINE] Gemini LLM initialized: model=gemini-2.0-flash-exp")
-    await broadcast_status("llm", "ready")
-    
-    # 3. Initialize TTS
-    await broadcast_status("tts", "initializing")
-    tts_instance = cartesia.TTS(
-        voice="a167e0f3-df7e-4d52-a9c3-f949145efdab"  # User-specified voice ID
-    )
-    logger.info(f"[PIPELINE] Cartesia TTS initialized: {type(tts_instance).__name__} (Voice ID: a167e0f3-df7e-4d52-a9c3-f949145efdab)")
-    await broadcast_status("tts", "ready")
+            logger.error(f"Failed to broadcast status for {', '.join(components)}: {e}")
     
-    # 4. Test Database Connection
-    await broadcast_status("database", "initializing")
-    try:
-        # Quick database connectivity test
-        session_test = await get_session(session_id)
-        logger.info(f"[PIPELINE] Supabase database connected")
-        await broadcast_status("database", "ready")
-    except Exception as e:
-        logger.error(f"[PIPELINE] Database connection failed: {e}")
-        await broadcast_status("database", "error")
+    def _flush_pending():
+        nonlocal flush_handle
+        flush_handle = None
+        components = dict(pending_status)
+        pending_status.clear()
+        _spawn(_publish_status(components))
+    
+    def broadcast_status(component: str, status: str):
+        nonlocal flush_handle
+        logger.info(f"Broadcasting status: {component} -> {status}")
+        pending_status[component] = status
+        if participant_joined and flush_handle is None:
+            flush_handle = asyncio.get_running_loop().call_later(0.02, _flush_pending)
+    
+    # Components are independent, so initialize them concurrently
+    async def _init_stt():
+        broadcast_status("stt", "initializing")
+        stt_instance = deepgram.STT()
+        logger.info(f"[PIPELINE] Deepgram STT initialized: {type(stt_instance).__name__}")
+        broadcast_status("stt", "ready")
+        return stt_instance
+    
+    async def _init_llm():
+        broadcast_status("llm", "initializing")
+        llm_instance = openai.LLM(model="gemini-2.0-flash-exp")
+        logger.info(f"[PIPELINE] Gemini LLM initialized: model=gemini-2.0-flash-exp")
+        broadcast_status("llm", "ready")
+        return llm_instance
+    
+    async def _init_tts():
+        broadcast_status("tts", "initializing")
+        tts_instance = cartesia.TTS(
+            voice="a167e0f3-df7e-4d52-a9c3-f949145efdab"  # User-specified voice ID
+        )
+        logger.info(f"[PIPELINE] Cartesia TTS initialized: {type(tts_instance).__name__} (Voice ID: a167e0f3-df7e-4d52-a9c3-f949145efdab)")
+        broadcast_status("tts", "ready")
+        return tts_instance
+    
+    async def _test_database():
+        broadcast_status("database", "initializing")
+        try:
+            # Quick database connectivity test
+            await get_session(session_id)
+            logger.info(f"[PIPELINE] Supabase database connected")
+            broadcast_status("database", "ready")
+        except Exception as e:
+            logger.error(f"[PIPELINE] Database connection failed: {e}")
+            broadcast_status("database", "error")
+    
+    async def _init_plugins():
+        return await asyncio.gather(_init_stt(), _init_llm(), _init_tts(), _test_database())
+    
+    async def _wait_for_participant():
+        nonlocal participant_joined
+        participant = next(iter(ctx.room.remote_participants.values()), None)
+        if participant is not None:
+            logger.info(f"Using existing participant: {participant.identity}")
+        else:
+            logger.info("Waiting for participant to join...")
+            participant = await ctx.wait_for_participant()
+            logger.info(f"Participant joined: {participant.identity}")
+        participant_joined = True
+        if pending_status and flush_handle is None:
+            _flush_pending()
+        return participant
+    
+    # Plugin initialization doesn't need the participant, so hide it behind
+    # the participant handshake
+    init_task = asyncio.create_task(_init_plugins())
+    participant_task = asyncio.create_task(_wait_for_participant())
+    (stt_instance, llm_instance, tts_instance, _), participant = await asyncio.gather(init_task, participant_task)
     
-    # 5. Initialize VAD
-    vad_instance = silero.VAD.load()
+    # VAD model is loaded once per process in prewarm()
+    vad_instance = ctx.proc.userdata["vad"]
     logger.info(f"[PIPELINE] Silero VAD loaded: {type(vad_instance).__name__}")
     
+    # Pass session_id to tools
+    tools_instance = AgentTools(room=ctx.room, chat_ctx=initial_ctx, session_id=session_id)
+    tools_list = llm.find_function_tools(tools_instance)
+
+    # Create session first (required for avatar initialization)
+    # Start LLM inference before the end of turn is confirmed, and shorten
+    # the silence needed to treat the user's turn as finished
+    session = AgentSession(
+        preemptive_generation=True,
+        min_endpointing_delay=0.3,
+        max_endpointing_delay=2.0,
+    )
+    logger.info("Agent session created")
+    
+    # Pipeline event logging is opt-in; each dispatch has a cost per turn
+    if _DEBUG_PIPELINE:
+        _register_pipeline_logging(session)
+    
     agent_config = Agent(
         instructions=system_instructions,
         vad=vad_instance,
@@ -319,7 +485,7 @@ async def entrypoint(ctx: JobContext):
     await asyncio.sleep(1)
     
     # Initialize Avatar Session AFTER agent session is ready
-    await broadcast_status("avatar", "initializing")
+    broadcast_status("avatar", "initializing")
     avatar = bey.AvatarSession(api_key=bey_key)
     avatar_ready = False
     
@@ -329,17 +495,17 @@ async def entrypoint(ctx: JobContext):
         await asyncio.wait_for(avatar.start(session, room=ctx.room), timeout=20.0)
         logger.info("[PIPELINE] ✓ Avatar session started successfully")
         avatar_ready = True
-        await broadcast_status("avatar", "ready")
+        broadcast_status("avatar", "ready")
         # Give avatar extra time to fully initialize streaming
         await asyncio.sleep(2)
     except asyncio.TimeoutError:
         logger.warning("[PIPELINE] ⚠ Avatar session startup timed out. Proceeding with voice only.")
         avatar_ready = False
-        await broadcast_status("avatar", "unavailable")
+        broadcast_status("avatar", "unavailable")
     except Exception as e:
         logger.error(f"[PIPELINE] ✗ Avatar failed: {e}", exc_info=True)
         avatar_ready = False
-        await broadcast_status("avatar", "error")
+        broadcast_status("avatar", "error")
     
     # Only send greeting AFTER both session and avatar are fully ready
     if avatar_ready:
@@ -347,20 +513,15 @@ async def entrypoint(ctx: JobContext):
         await asyncio.sleep(1)
     
     logger.info("[PIPELINE] Sending greeting...")
-    await session.say("Hello! I'm your clinic appointment assistant. How can I help you today? Would you like to schedule, reschedule, or cancel an appointment?", allow_interruptions=True)
+    # say() schedules playout and returns a handle; don't block on it
+    session.say("Hello! I'm your clinic appointment assistant. How can I help you today? Would you like to schedule, reschedule, or cancel an appointment?", allow_interruptions=True)
     
     logger.info("[PIPELINE] ✓ Agent is now listening for user speech...")
     
     # Keep session alive until room closes
-    try:
-        # Wait indefinitely - session will stay active
-        await asyncio.Event().wait()
-    except asyncio.CancelledError:
-        logger.info(f"Session ending for room {ctx.room.name}")
-    finally:
-        # Clean up session when it ends
-        await delete_session(session_id)
-        logger.info(f"Deleted session record for {session_id}")
+    await disconnected.wait()
+    logger.info(f"Session ending for room {ctx.room.name}")
+    await cleanup()
 
 if __name__ == "__main__":
-    cli.run_app(WorkerOptions(entrypoint_fnc=entrypoint))
+    cli.run_app(WorkerOptions(entrypoint_fnc=entrypoint, prewarm_fnc=prewarm))
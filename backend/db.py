@@ -1,6 +1,8 @@
 import os
 import asyncio
-from supabase import create_client, Client
+from concurrent.futures import ThreadPoolExecutor
+from async_lru import alru_cache
+from supabase import create_client, Client, ClientOptions
 from dotenv import load_dotenv
 
 # Load env from the same directory as this file
@@ -9,21 +11,40 @@ load_dotenv()
 url: str = os.environ.get("SUPABASE_URL")
 key: str = os.environ.get("SUPABASE_KEY")
 
-supabase: Client = create_client(url, key)
+supabase: Client = create_client(url, key, options=ClientOptions(postgrest_client_timeout=10))
 
+# supabase-py is synchronous; run queries on a small pool so the event loop
+# keeps servicing audio while a request is in flight
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="supabase")
+
+async def _exec(query):
+    """Execute a PostgREST query builder off the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, query.execute)
+
+def warmup():
+    """
+    Issue a trivial query so the TCP/TLS connection to Supabase is already
+    open before the first session needs it. Called once per worker process.
+    """
+    supabase.table("users").select("id").limit(1).execute()
+
+@alru_cache(maxsize=1024, ttl=60)
 async def get_user_by_contact(contact_number: str):
-    response = supabase.table("users").select("*").eq("contact_number", contact_number).execute()
+    response = await _exec(supabase.table("users").select("*").eq("contact_number", contact_number))
     if response.data:
         return response.data[0]
     return None
 
+@alru_cache(maxsize=1024, ttl=60)
 async def get_user_by_email(email: str):
     """Get user by email address"""
-    response = supabase.table("users").select("*").eq("email", email).execute()
+    response = await _exec(supabase.table("users").select("*").eq("email", email))
     if response.data:
         return response.data[0]
     return None
 
+@alru_cache(maxsize=1024, ttl=60)
 async def get_user_by_contact_or_email(identifier: str):
     """
     Get user by either contact number or email.
@@ -47,26 +68,28 @@ async def create_user(contact_number: str, name: str = None, email: str = None):
     if email:
         data["email"] = email
     
-    response = supabase.table("users").insert(data).execute()
+    response = await _exec(supabase.table("users").insert(data))
+    # Lookups are cached per process for 60 s, including "not found" results;
+    # drop this user's entries so the new account is visible immediately
+    get_user_by_contact.cache_invalidate(contact_number)
+    get_user_by_contact_or_email.cache_invalidate(contact_number)
+    if email:
+        get_user_by_email.cache_invalidate(email)
+        get_user_by_contact_or_email.cache_invalidate(email)
     if response.data:
         return response.data[0]
     return None
 
 
-async def get_user_by_id(user_id: str):
-    response = supabase.table("users").select("*").eq("id", user_id).execute()
-    if response.data:
-        return response.data[0]
-    return None
-
 async def get_appointments(user_id: str):
-    # Get user's contact number first
-    user = await get_user_by_id(user_id)
-    if not user:
-        return []
-    
+    # Join through users so the contact number lookup happens in the same query.
     # Only fetch active (booked) appointments, not cancelled ones
-    response = supabase.table("appointments").select("*").eq("contact_number", user["contact_number"]).eq("status", "booked").execute()
+    response = await _exec(
+        supabase.table("appointments")
+        .select("id, appointment_time, status, details, created_at, users!inner(id)")
+        .eq("users.id", user_id)
+        .eq("status", "booked")
+    )
     # Format to match expected structure
     appointments = []
     for appt in response.data:
@@ -81,45 +104,52 @@ async def get_appointments(user_id: str):
 
 async def create_appointment(user_id: str, start_time: str, duration_mins: int = 30, summary: str = None):
     # Check for conflicts? For now, just insert.
-    # Note: The appointments table uses 'contact_number' not 'user_id'
-    # First get the user's contact number
-    user = await get_user_by_id(user_id)
-    if not user:
-        return None
+    # Note: The appointments table uses 'contact_number' not 'user_id';
+    # create_appointment_for_user resolves it in the database
     
     # Combine duration and summary into details field
     details_text = summary or f"{duration_mins} minute appointment"
     
-    data = {
-        "contact_number": user["contact_number"],
-        "appointment_time": start_time,
-        "details": details_text,
-        "status": "booked"
+    params = {
+        "p_user_id": user_id,
+        "p_appointment_time": start_time,
+        "p_details": details_text
     }
-    response = supabase.table("appointments").insert(data).execute()
+    response = await _exec(supabase.rpc("create_appointment_for_user", params))
     if response.data:
         return response.data[0]
     return None
 
-async def reschedule_appointment(appointment_id: str, new_time: str):
+async def reschedule_appointment(appointment_id: str, new_time: str, contact_number: str):
     """
     Reschedule an existing appointment by updating its time.
+    Only updates a booked appointment owned by the given user, so ownership
+    is checked in the same request.
     
     Args:
         appointment_id: The ID of the appointment to reschedule
         new_time: ISO string of the new time (e.g., 2023-10-27T14:00:00)
+        contact_number: Contact number of the user who owns the appointment
+    
+    Returns the updated appointment, or None if no matching appointment exists.
     """
     data = {
         "appointment_time": new_time
     }
-    response = supabase.table("appointments").update(data).eq("id", appointment_id).eq("status", "booked").execute()
+    response = await _exec(supabase.table("appointments").update(data).eq("id", appointment_id).eq("contact_number", contact_number).eq("status", "booked"))
     if response.data:
         return response.data[0]
     return None
 
-async def cancel_appointment(appointment_id: str):
-    response = supabase.table("appointments").update({"status": "cancelled"}).eq("id", appointment_id).execute()
-    return response.data
+async def cancel_appointment(appointment_id: str, contact_number: str):
+    """
+    Cancel a booked appointment owned by the given user.
+    Returns the cancelled appointment, or None if no matching appointment exists.
+    """
+    response = await _exec(supabase.table("appointments").update({"status": "cancelled"}).eq("id", appointment_id).eq("contact_number", contact_number).eq("status", "booked"))
+    if response.data:
+        return response.data[0]
+    return None
 
 async def check_availability(date: str, time_slot: str):
     """
@@ -132,24 +162,34 @@ async def check_availability(date: str, time_slot: str):
     """
     # Construct the datetime string
     datetime_str = f"{date}T{time_slot}:00"
+    return await is_time_available(datetime_str)
+
+async def is_time_available(datetime_str: str, exclude_appointment_id: str = None):
+    """
+    Check whether no booked appointment exists at an exact datetime.
     
-    # Query for any appointments at this exact time
-    response = supabase.table("appointments").select("id").eq("appointment_time", datetime_str).eq("status", "booked").execute()
+    Args:
+        datetime_str: ISO datetime string, compared as stored
+        exclude_appointment_id: Appointment to ignore, e.g. the one being rescheduled
+    """
+    # Query for any appointment at this exact time; one match is enough
+    query = supabase.table("appointments").select("id").eq("appointment_time", datetime_str).eq("status", "booked")
+    if exclude_appointment_id is not None:
+        query = query.neq("id", exclude_appointment_id)
+    response = await _exec(query.limit(1))
     
     # If no appointments found, slot is available
-    is_available = len(response.data) == 0
-    return is_available
+    return not response.data
 
-async def save_message(user_id: str, role: str, content: str):
-    data = {
-        "user_id": user_id,
-        "role": role,
-        "content": content
-    }
-    supabase.table("messages").insert(data).execute()
+async def save_messages(rows: list):
+    """
+    Insert several message rows in a single request.
+    Each row is a dict with user_id, role and content.
+    """
+    await _exec(supabase.table("messages").insert(rows))
 
 async def get_chat_history(user_id: str, limit: int = 50):
-    response = supabase.table("messages").select("*").eq("user_id", user_id).order("created_at", desc=True).limit(limit).execute()
+    response = await _exec(supabase.table("messages").select("*").eq("user_id", user_id).order("created_at", desc=True).limit(limit))
     # Reverse to get chronological order
     return response.data[::-1] if response.data else []
 
@@ -171,7 +211,7 @@ async def create_session(session_id: str):
         "last_activity_at": "now()"
     }
     # Use upsert to avoid duplicate key errors
-    response = supabase.table("session_memory").upsert(data, on_conflict="session_id").execute()
+    response = await _exec(supabase.table("session_memory").upsert(data, on_conflict="session_id"))
     return response.data[0] if response.data else None
 
 async def update_session_user(session_id: str, user_id: str):
@@ -183,14 +223,14 @@ async def update_session_user(session_id: str, user_id: str):
         "user_id": user_id,
         "last_activity_at": "now()"
     }
-    response = supabase.table("session_memory").update(data).eq("session_id", session_id).execute()
+    response = await _exec(supabase.table("session_memory").update(data).eq("session_id", session_id))
     return response.data[0] if response.data else None
 
 async def get_session(session_id: str):
     """
     Get session information.
     """
-    response = supabase.table("session_memory").select("*").eq("session_id", session_id).execute()
+    response = await _exec(supabase.table("session_memory").select("*").eq("session_id", session_id))
     return response.data[0] if response.data else None
 
 async def delete_session(session_id: str):
@@ -198,5 +238,5 @@ async def delete_session(session_id: str):
     Delete session when it ends.
     Called when LiveKit session closes.
     """
-    response = supabase.table("session_memory").delete().eq("session_id", session_id).execute()
+    response = await _exec(supabase.table("session_memory").delete().eq("session_id", session_id))
     return response.data
@@ -9,11 +9,11 @@ import os
 import sys
 from livekit.agents import cli
 from livekit.agents import WorkerOptions
-from agent import entrypoint
+from agent import entrypoint, prewarm
 
 if __name__ == "__main__":
     # Ensure env vars are loaded
     from dotenv import load_dotenv
     load_dotenv()  # Load from current directory (backend/.env)
     
-    cli.run_app(WorkerOptions(entrypoint_fnc=entrypoint))
+    cli.run_app(WorkerOptions(entrypoint_fnc=entrypoint, prewarm_fnc=prewarm))
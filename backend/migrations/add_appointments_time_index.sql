@@ -0,0 +1,10 @@
+-- Migration: Index booked appointments by time
+-- Created: 2026-10-15
+-- Description: Partial index backing check_availability lookups. Only booked
+-- rows are indexed, so cancelled appointments never need to be scanned.
+-- CONCURRENTLY avoids locking the table; run this file on its own, outside a
+-- transaction block.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_appt_time_status
+ON public.appointments(appointment_time)
+WHERE status = 'booked';
@@ -0,0 +1,79 @@
+-- Migration: Relate appointments to users and add server-side booking function
+-- Created: 2026-10-15
+-- Description: Lets PostgREST embed users in appointment queries so a user's
+-- appointments can be fetched in one round-trip, and resolves the user's
+-- contact number inside the database when booking.
+--
+-- Required before deploying the backend that uses users!inner(...) in
+-- get_appointments and the create_appointment_for_user RPC.
+--
+-- Order:
+--   1. Run this file. It stops with an error if two users share a contact
+--      number; merge or fix those users first (query in step 1 below).
+--   2. The foreign key is added NOT VALID, so existing appointments whose
+--      contact number has no matching user don't block it. New and updated
+--      rows are checked immediately.
+--   3. Fix orphaned appointments (query in step 3 below), then run the
+--      VALIDATE CONSTRAINT statement at the end of this file.
+
+-- Step 1: contact_number must be unique to be referenced by a foreign key
+DO $$
+DECLARE
+  dup_count integer;
+BEGIN
+  SELECT count(*) INTO dup_count
+  FROM (
+    SELECT contact_number
+    FROM public.users
+    WHERE contact_number IS NOT NULL
+    GROUP BY contact_number
+    HAVING count(*) > 1
+  ) d;
+
+  IF dup_count > 0 THEN
+    RAISE EXCEPTION '% contact number(s) are shared by multiple users; resolve them before running this migration', dup_count
+      USING HINT = 'SELECT contact_number, array_agg(id) FROM public.users GROUP BY contact_number HAVING count(*) > 1;';
+  END IF;
+END $$;
+
+CREATE UNIQUE INDEX IF NOT EXISTS users_contact_number_key
+ON public.users(contact_number);
+
+-- Step 2: foreign key used by PostgREST for users!inner(...) embedding
+ALTER TABLE public.appointments
+DROP CONSTRAINT IF EXISTS appointments_contact_number_fkey;
+
+ALTER TABLE public.appointments
+ADD CONSTRAINT appointments_contact_number_fkey
+FOREIGN KEY (contact_number) REFERENCES public.users(contact_number)
+ON UPDATE CASCADE
+NOT VALID;
+
+-- Book an appointment for a user id without a separate user lookup.
+-- Returns no rows if the user does not exist.
+CREATE OR REPLACE FUNCTION public.create_appointment_for_user(
+  p_user_id uuid,
+  p_appointment_time public.appointments.appointment_time%TYPE,
+  p_details text
+)
+RETURNS SETOF public.appointments
+LANGUAGE sql
+AS $$
+  INSERT INTO public.appointments (contact_number, appointment_time, details, status)
+  SELECT u.contact_number, p_appointment_time, p_details, 'booked'
+  FROM public.users u
+  WHERE u.id = p_user_id
+  RETURNING *;
+$$;
+
+COMMENT ON FUNCTION public.create_appointment_for_user IS 'Insert a booked appointment for the given user id';
+
+-- Step 3: find appointments with no matching user (must return no rows
+-- before validating):
+-- SELECT a.id, a.contact_number
+-- FROM public.appointments a
+-- LEFT JOIN public.users u ON u.contact_number = a.contact_number
+-- WHERE a.contact_number IS NOT NULL AND u.id IS NULL;
+--
+-- Then validate existing rows:
+-- ALTER TABLE public.appointments VALIDATE CONSTRAINT appointments_contact_number_fkey;
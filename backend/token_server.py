@@ -1,13 +1,18 @@
 import os
-import uuid
+import secrets
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from livekit import api
 from dotenv import load_dotenv
 
 load_dotenv()  # Load from current directory (backend/.env)
 
-app = FastAPI()
+# Credentials never change while the server runs
+_API_KEY = os.getenv("LIVEKIT_API_KEY")
+_API_SECRET = os.getenv("LIVEKIT_API_SECRET")
+
+app = FastAPI(default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -22,13 +27,10 @@ async def root():
 @app.get("/getToken")
 async def get_token(name: str = "User"):
     # Generate a unique room name for this session
-    room_name = f"session-{uuid.uuid4().hex[:12]}"
+    room_name = "session-" + secrets.token_hex(6)
     
     # Generate a token for the user
-    token = api.AccessToken(
-        os.getenv("LIVEKIT_API_KEY"),
-        os.getenv("LIVEKIT_API_SECRET")
-    ).with_identity(name) \
+    token = api.AccessToken(_API_KEY, _API_SECRET).with_identity(name) \
     .with_name(name) \
     .with_grants(api.VideoGrants(
         room_join=True,
@@ -41,4 +43,12 @@ async def get_token(name: str = "User"):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(
+        "token_server:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=2,
+        log_level="warning",
+    )
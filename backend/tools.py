@@ -1,4 +1,9 @@
+import asyncio
+import functools
 import logging
+import time
+import orjson
+from datetime import datetime
 from livekit.agents import llm
 from typing import Annotated # Keep if needed, or remove. I'll keep it just in case but I removed usages.
 from db import (
@@ -11,26 +16,78 @@ from db import (
     reschedule_appointment,
     cancel_appointment, 
     check_availability,
+    is_time_available,
     get_chat_history,
     update_session_user
 )
 
 logger = logging.getLogger("voice-agent")
 
+_SLOTS_RESPONSE = "Available slots: Tomorrow at 10:00 AM, Tomorrow at 2:00 PM, and Friday at 11:00 AM."
+
+# Strips brackets and turns dashes into spaces in a single pass
+_MOBILE_TRANS = str.maketrans({"-": " ", "(": "", ")": ""})
+
 class AgentTools:
     def __init__(self, room, chat_ctx, session_id: str):
         self._user = None
+        # Bound by _bind_user once the user is identified
+        self._uid = None
+        self._contact = None
+        self._get_user_appts = None
         self._room = room
         self._chat_ctx = chat_ctx
+        # Resolved once; chat contexts without persistence don't define it
+        self._set_user_id = getattr(chat_ctx, 'set_user_id', None)
         self._session_id = session_id  # Store session ID
+        self._pending_events: set[asyncio.Task] = set()
+        # user_id -> (fetched_at, appointments, appointment ids)
+        self._appt_cache: dict[str, tuple[float, list, frozenset]] = {}
+
+    def _bind_user(self, user: dict):
+        """Remember the identified user and pre-bind per-user DB calls."""
+        self._user = user
+        self._uid = user['id']
+        # Appointments are owned by contact number (see cancel/reschedule)
+        self._contact = user['contact_number']
+        self._get_user_appts = functools.partial(get_appointments, self._uid)
+
+    async def _get_appointments_cached(self):
+        """
+        Return the user's active appointments and their ids, reusing a
+        result fetched in the last few seconds.
+        """
+        cached = self._appt_cache.get(self._uid)
+        if cached and time.monotonic() - cached[0] < 5.0:
+            return cached[1], cached[2]
+        return await self._refresh_appointments()
+
+    async def _refresh_appointments(self):
+        appts = await self._get_user_appts()
+        # Ids are compared as strings since the LLM passes them back as text
+        ids = frozenset(str(appt['id']) for appt in appts)
+        self._appt_cache[self._uid] = (time.monotonic(), appts, ids)
+        return appts, ids
 
-    async def _emit_event(self, event_type: str, message: str):
+    def _emit_event(self, event_type: str, message: str):
+        """
+        Publish a UI event without blocking the tool call.
+        Events are advisory, so the tool result never waits on the publish.
+        """
         if self._room:
-            logger.info(f"Emitting event: {event_type} - {message}")
+            logger.info("Emitting event: %s - %s", event_type, message)
+            task = asyncio.create_task(self._publish_event(event_type, message))
+            self._pending_events.add(task)
+            task.add_done_callback(self._pending_events.discard)
+
+    async def _publish_event(self, event_type: str, message: str):
+        try:
             await self._room.local_participant.publish_data(
-                payload=f'{{"type": "{event_type}", "message": "{message}"}}',
+                payload=orjson.dumps({"type": event_type, "message": message}),
                 reliable=True
             )
+        except Exception as e:
+            logger.error(f"Failed to emit event {event_type}: {e}")
 
     @llm.function_tool(description="Identify the user by their contact number or email address")
     async def identify_user(
@@ -45,32 +102,36 @@ class AgentTools:
         Args:
             identifier: User's mobile number or email address
         """
-        await self._emit_event("tool_call", f"Identifying user: {identifier}")
+        self._emit_event("tool_call", f"Identifying user: {identifier}")
         logger.info(f"Identifying user with identifier: {identifier}")
         
         # Search by contact number OR email
         user = await get_user_by_contact_or_email(identifier)
         
         if not user:
-            await self._emit_event("tool_result", "User not found in system")
+            self._emit_event("tool_result", "User not found in system")
             return f"No user found with identifier {identifier}. The user needs to create an account first."
             
-        self._user = user
+        self._bind_user(user)
         
-        # Update session with user_id (tag this session to this user)
-        await update_session_user(self._session_id, user['id'])
-        logger.info(f"Session {self._session_id} tagged to user {user['id']}")
+        # Update session with user_id (tag this session to this user).
+        # Started first so the DB write overlaps with the rest of this call.
+        update_task = asyncio.create_task(update_session_user(self._session_id, user['id']))
         
         # Set user ID in chat context for message saving
-        if self._chat_ctx and hasattr(self._chat_ctx, 'set_user_id'):
-            self._chat_ctx.set_user_id(user['id'])
+        if self._set_user_id is not None:
+            self._set_user_id(user['id'])
         
         msg = f"User identified: {user.get('name', 'Guest')} (ID: {user['id']})."
         
         # NO CHAT HISTORY LOADING - Each session is independent
         logger.info(f"User identified - session-scoped memory only, no history loaded")
         
-        await self._emit_event("tool_result", msg)
+        self._emit_event("tool_result", msg)
+        
+        # Make sure the session is tagged before returning to the LLM
+        await update_task
+        logger.info(f"Session {self._session_id} tagged to user {user['id']}")
         return msg
 
     @llm.function_tool(description="Format a mobile number for verbal confirmation")
@@ -87,7 +148,7 @@ class AgentTools:
         """
         # Format the number with spaces for easier verbal confirmation
         # Example: "555-123-4567" or "+1 555 123 4567"
-        formatted = mobile_number.replace("-", " ").replace("(", "").replace(")", "")
+        formatted = mobile_number.translate(_MOBILE_TRANS)
         return f"I heard your mobile number as: {formatted}. Is that correct?"
 
     @llm.function_tool(description="Spell out a name letter by letter for verification")
@@ -102,7 +163,7 @@ class AgentTools:
             name: The name to spell out
         """
         # Spell out each letter with spaces
-        spelled = " - ".join(list(name.upper()))
+        spelled = " - ".join(name.upper())
         return f"Let me confirm the spelling: {spelled}. Is that correct?"
 
     @llm.function_tool(description="Spell out an email address for verification")
@@ -119,7 +180,7 @@ class AgentTools:
         # Split email into username and domain for clearer verbal confirmation
         if "@" in email:
             username, domain = email.split("@", 1)
-            return f"Let me confirm your email: {username} at {domain}. That's {' '.join(list(username))} AT {' '.join(list(domain))}. Is that correct?"
+            return f"Let me confirm your email: {username} at {domain}. That's {' '.join(username)} AT {' '.join(domain)}. Is that correct?"
         else:
             return f"The email format seems incorrect. Please provide it again with the @ symbol."
 
@@ -143,7 +204,7 @@ class AgentTools:
             last_name: User's verified last name
             email: User's verified email address
         """
-        await self._emit_event("tool_call", f"Creating user account for {first_name} {last_name}")
+        self._emit_event("tool_call", f"Creating user account for {first_name} {last_name}")
         logger.info(f"Creating new user account: {contact_number}, {first_name} {last_name}, {email}")
         
         # Combine first and last name
@@ -153,16 +214,16 @@ class AgentTools:
         user = await create_user(contact_number=contact_number, name=full_name, email=email)
         
         if user:
-            self._user = user
+            self._bind_user(user)
             
             # Set user ID in chat context
-            if self._chat_ctx and hasattr(self._chat_ctx, 'set_user_id'):
-                self._chat_ctx.set_user_id(user['id'])
+            if self._set_user_id is not None:
+                self._set_user_id(user['id'])
             
-            await self._emit_event("tool_result", f"Account created successfully for {full_name}")
+            self._emit_event("tool_result", f"Account created successfully for {full_name}")
             return f"Account created successfully! Welcome {full_name}. Your information has been securely saved."
         else:
-            await self._emit_event("tool_result", "Failed to create account")
+            self._emit_event("tool_result", "Failed to create account")
             return "I'm sorry, there was an error creating your account. Please try again."
 
     @llm.function_tool(description="Check if a specific date and time slot is available")
@@ -179,7 +240,7 @@ class AgentTools:
             date: The date in YYYY-MM-DD format
             time: The time in HH:MM format (24-hour)
         """
-        await self._emit_event("tool_call", f"Checking availability for {date} at {time}")
+        self._emit_event("tool_call", f"Checking availability for {date} at {time}")
         logger.info(f"Checking availability: {date} {time}")
         
         is_available = await check_availability(date, time)
@@ -191,9 +252,9 @@ class AgentTools:
 
     @llm.function_tool(description="Get available appointment slots")
     async def fetch_slots(self):
-        await self._emit_event("tool_call", "Fetching available slots")
+        self._emit_event("tool_call", "Fetching available slots")
         logger.info("Fetching slots")
-        return "Available slots: Tomorrow at 10:00 AM, Tomorrow at 2:00 PM, and Friday at 11:00 AM."
+        return _SLOTS_RESPONSE
 
     @llm.function_tool(description="Book an appointment")
     async def book_appointment(
@@ -207,14 +268,15 @@ class AgentTools:
             start_time: ISO string of the start time (e.g., 2023-10-27T10:00:00)
             duration: Duration in minutes
         """
-        if not self._user:
+        if self._uid is None:
             return "Please identify the user first before booking."
         
-        await self._emit_event("tool_call", f"Booking appointment at {start_time}")
-        logger.info(f"Booking appointment for {self._user['id']} at {start_time}")
-        appt = await create_appointment(self._user['id'], start_time, duration)
+        self._emit_event("tool_call", f"Booking appointment at {start_time}")
+        logger.info(f"Booking appointment for {self._uid} at {start_time}")
+        appt = await create_appointment(self._uid, start_time, duration)
         if appt:
-            await self._emit_event("tool_result", "Appointment booked successfully")
+            self._appt_cache.pop(self._uid, None)
+            self._emit_event("tool_result", "Appointment booked successfully")
             return f"Appointment booked successfully for {start_time}."
         return "Failed to book appointment."
 
@@ -232,41 +294,61 @@ class AgentTools:
             appointment_id: The ID of the appointment to reschedule
             new_time: ISO string of the new time (e.g., 2023-10-27T14:00:00)
         """
-        if not self._user:
+        if self._uid is None:
             return "Please identify the user first before rescheduling."
         
-        await self._emit_event("tool_call", f"Rescheduling appointment {appointment_id} to {new_time}")
+        self._emit_event("tool_call", f"Rescheduling appointment {appointment_id} to {new_time}")
         logger.info(f"Rescheduling appointment {appointment_id} to {new_time}")
         
-        # Verify the appointment belongs to this user
-        user_appointments = await get_appointments(self._user['id'])
-        appointment_exists = any(appt['id'] == appointment_id for appt in user_appointments)
+        try:
+            # Normalized once so the slot that is checked is the slot that is written
+            new_slot = datetime.fromisoformat(new_time).isoformat()
+        except ValueError:
+            return "I couldn't understand the new time. Please provide it as a date and time, for example 2023-10-27T14:00:00."
+        
+        # Ownership and availability are independent lookups, so overlap them.
+        # The appointment's own current slot doesn't count as a conflict.
+        owned, available = await asyncio.gather(
+            self._get_appointments_cached(),
+            is_time_available(new_slot, exclude_appointment_id=appointment_id),
+            return_exceptions=True,
+        )
+        if isinstance(owned, Exception):
+            logger.error(f"Failed to load appointments for ownership check: {owned}")
+            return "I'm sorry, there was an error rescheduling your appointment. Please try again."
+        if isinstance(available, Exception):
+            logger.error(f"Failed to check availability for {new_time}: {available}")
+            return "I'm sorry, there was an error rescheduling your appointment. Please try again."
         
-        if not appointment_exists:
+        _, appointment_ids = owned
+        if str(appointment_id) not in appointment_ids:
             return "I couldn't find that appointment. Please check your appointments and try again."
+        if not available:
+            return f"I'm sorry, the time slot at {new_time} is already booked. Would you like to try a different time?"
         
-        # Reschedule the appointment
-        result = await reschedule_appointment(appointment_id, new_time)
+        # Only updates the appointment if it belongs to this user
+        result = await reschedule_appointment(appointment_id, new_slot, self._contact)
         
-        if result:
-            await self._emit_event("tool_result", "Appointment rescheduled successfully")
-            return f"Your appointment has been rescheduled to {new_time}."
-        else:
-            return "I'm sorry, there was an error rescheduling your appointment. Please try again."
+        if result is None:
+            return "I couldn't find that appointment. Please check your appointments and try again."
+        
+        self._appt_cache.pop(self._uid, None)
+        self._emit_event("tool_result", "Appointment rescheduled successfully")
+        return f"Your appointment has been rescheduled to {new_time}."
 
     @llm.function_tool(description="Retrieve user's past and upcoming appointments")
     async def retrieve_appointments(self):
-        if not self._user:
+        if self._uid is None:
             return "Please identify the user first."
         
-        await self._emit_event("tool_call", "Retrieving appointments")
-        appts = await get_appointments(self._user['id'])
+        self._emit_event("tool_call", "Retrieving appointments")
+        appts, _ = await self._refresh_appointments()
         if not appts:
             return "No active appointments found."
         
         # Format list with IDs for easier cancellation
         summary = "\n".join([f"- Appointment on {a['start_time']} - {a.get('details', 'No details')} (ID: {a['id']})" for a in appts])
-        await self._emit_event("tool_result", f"Found {len(appts)} appointments")
+        self._emit_event("tool_result", f"Found {len(appts)} appointments")
         return f"Found {len(appts)} active appointment(s):\n{summary}"
 
     @llm.function_tool(description="Cancel an appointment by its ID")
@@ -281,24 +363,18 @@ class AgentTools:
         Args:
             appointment_id: The ID of the appointment to cancel
         """
-        if not self._user:
+        if self._uid is None:
             return "Please identify the user first before canceling an appointment."
         
-        await self._emit_event("tool_call", f"Canceling appointment {appointment_id}")
-        logger.info(f"Canceling appointment {appointment_id} for user {self._user['id']}")
+        self._emit_event("tool_call", f"Canceling appointment {appointment_id}")
+        logger.info(f"Canceling appointment {appointment_id} for user {self._uid}")
         
-        # First verify the appointment belongs to this user
-        user_appointments = await get_appointments(self._user['id'])
-        appointment_exists = any(appt['id'] == appointment_id for appt in user_appointments)
+        # Only cancels the appointment if it belongs to this user
+        result = await cancel_appointment(appointment_id, self._contact)
         
-        if not appointment_exists:
+        if result is None:
             return f"I couldn't find an active appointment with that ID. Please check your appointments and try again."
         
-        # Cancel the appointment
-        result = await cancel_appointment(appointment_id)
-        
-        if result:
-            await self._emit_event("tool_result", "Appointment cancelled successfully")
-            return "Your appointment has been cancelled successfully. Is there anything else I can help you with?"
-        else:
-            return "I'm sorry, there was an error cancelling your appointment. Please try again or contact support."
+        self._appt_cache.pop(self._uid, None)
+        self._emit_event("tool_result", "Appointment cancelled successfully")
+        return "Your appointment has been cancelled successfully. Is there anything else I can help you with?"
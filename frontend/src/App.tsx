@@ -122,10 +122,12 @@ function RoomContent({ setIsConnected, userInitiatedDisconnect }: {
       try {
         const data = JSON.parse(message);
         if (data.type === 'system_status') {
-          console.log(`System status: ${data.component} -> ${data.status}`);
+          // Backend coalesces updates: { components: { stt: 'ready', ... } }
+          const components = data.components ?? { [data.component]: data.status };
+          console.log("System status:", components);
           setSystemStatus(prev => ({
             ...prev,
-            [data.component]: data.status
+            ...components
           }));
         }
       } catch (e) {
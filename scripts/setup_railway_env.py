@@ -1,6 +1,12 @@
 import os
+import re
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# KEY=value, optionally prefixed with "export". The value is captured from
+# inside a matching pair of double or single quotes, or bare and trimmed.
+_ENV_RE = re.compile(r'^\s*(?:export\s+)?([A-Za-z_][A-Za-z0-9_]*)\s*=\s*(?:"(.*)"|\'(.*)\'|(.*?))\s*$')
 
 def parse_env_file(filepath):
     vars_dict = {}
@@ -8,46 +14,62 @@ def parse_env_file(filepath):
         print(f"Warning: {filepath} not found.")
         return vars_dict
     
-    with open(filepath, 'r') as f:
+    with open(filepath, 'r', encoding='utf-8') as f:
         for line in f:
-            line = line.strip()
-            if not line or line.startswith('#'):
+            # Skip comments; blank lines simply don't match _ENV_RE
+            if line.lstrip().startswith('#'):
                 continue
-            if '=' in line:
-                key, val = line.split('=', 1)
-                vars_dict[key.strip()] = val.strip()
+            m = _ENV_RE.match(line)
+            if m:
+                vars_dict[m.group(1)] = next(v for v in m.group(2, 3, 4) if v is not None)
     return vars_dict
 
 def set_vars(service_name, vars_dict):
     if not vars_dict:
-        return
+        return False
     
     print(f"Setting variables for service: {service_name}")
     # Construct command: railway variable set key=value key2=value2 --service service_name --skip-deploys
-    # Wait, check if multiple args are supported. Usually yes.
-    # If not, loop.
+    # Deploys are skipped here and triggered once per service at the end.
     
     cmd = ["railway", "variable", "set"]
     for k, v in vars_dict.items():
         cmd.append(f"{k}={v}")
     
     cmd.extend(["--service", service_name])
-    # cmd.append("--skip-deploys") # Use this to avoid multiple deploys, trigger one at end manually if needed.
+    cmd.append("--skip-deploys")
     
     print(f"Running command for {service_name} with {len(vars_dict)} variables...")
-    try:
-        subprocess.run(cmd, check=True)
+    # Capture output so concurrent runs don't interleave on the terminal
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode == 0:
         print(f"Success for {service_name}")
-    except subprocess.CalledProcessError as e:
-        print(f"Error setting variables for {service_name}: {e}")
+        return True
+    print(f"Error setting variables for {service_name}: {result.stderr.strip() or result.stdout.strip()}")
+    return False
+
+def redeploy(service_name):
+    print(f"Redeploying service: {service_name}")
+    result = subprocess.run(["railway", "redeploy", "--service", service_name, "--yes"], capture_output=True, text=True)
+    if result.returncode == 0:
+        print(f"Redeploy started for {service_name}")
+        return True
+    # Variables were set with --skip-deploys, so they stay undeployed until this succeeds
+    print(f"Error redeploying {service_name}: {result.stderr.strip() or result.stdout.strip()}")
+    return False
 
 if __name__ == "__main__":
-    # Backend
-    backend_vars = parse_env_file("backend/.env")
-    if backend_vars:
-        set_vars("backend", backend_vars)
+    services = {
+        "backend": parse_env_file("backend/.env"),
+        "frontend": parse_env_file("frontend/.env"),
+    }
+    services = {name: vars_dict for name, vars_dict in services.items() if vars_dict}
+    
+    # The two services are independent, so set their variables in parallel
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = dict(zip(services, executor.map(set_vars, services, services.values())))
     
-    # Frontend
-    frontend_vars = parse_env_file("frontend/.env")
-    if frontend_vars:
-        set_vars("frontend", frontend_vars)
+    # One deploy per updated service instead of one per variable change
+    for name, ok in results.items():
+        if ok:
+            redeploy(name)